@@ -1,12 +1,20 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import requests
-import json
+import orjson
+import io
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from PIL import Image
+from selectolax.lexbor import LexborHTMLParser
 from pydantic import BaseModel, Field
 from typing import Optional, Literal
-import google.generativeai as genai
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google import genai
+from google.genai import types
 
 # --- 1. CONFIGURATION & MODELS ---
 
@@ -48,6 +56,12 @@ if not check_password():
 
 # --- FIN SECURITY GATEKEEPER (Le reste du code s'exécute seulement si auth OK) ---
 
+# Options des listes déroulantes (index précalculés pour les selectbox)
+VENDEUR_OPTIONS = ("Agence", "Particulier", "Autre")
+VENDEUR_INDEX = {v: i for i, v in enumerate(VENDEUR_OPTIONS)}
+STATUS_OPTIONS = ("Non", "A contacter", "Contacté")
+STATUS_INDEX = {v: i for i, v in enumerate(STATUS_OPTIONS)}
+
 # Modèle de données strict (Pydantic)
 class ImmoData(BaseModel):
     date: str = Field(default_factory=lambda: datetime.now().strftime("%Y-%m-%d"))
@@ -67,105 +81,263 @@ class ImmoData(BaseModel):
     create_draft: bool = False
     message_draft: Optional[str] = ""
 
+@st.cache_data(show_spinner=False)
+def _empty_form_template():
+    """Formulaire vide validé une seule fois par process ; seule la date est recalculée par session"""
+    return ImmoData().model_dump()
+
 # --- 2. FONCTIONS BACKEND ---
 
+HTTP_TIMEOUT = (3.05, 10)  # (connexion, lecture)
+
+@st.cache_resource(show_spinner=False)
+def _get_session():
+    """Session HTTP partagée entre les reruns : keep-alive pour éviter un handshake TLS à chaque appel"""
+    session = requests.Session()
+    session.headers.update({
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+    })
+    session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=Retry(total=2, backoff_factor=0.3)))
+    session.mount('http://', HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=Retry(total=2, backoff_factor=0.3)))
+    return session
+
+IMAGE_MAX_SIDE = 1024  # Au-delà, Gemini redimensionne de toute façon
+
+JPEG_QUALITY = 85
+
+def _encode_image(data: bytes) -> bytes:
+    """Décode une image, la réduit en RGB et la ré-encode en JPEG. Exécuté dans un thread : pas d'appel st.* ici."""
+    image = Image.open(io.BytesIO(data))  # Lecture de l'en-tête seulement
+    if image.format == "JPEG" and image.mode == "RGB" and max(image.size) <= IMAGE_MAX_SIDE:
+        return data  # JPEG déjà à la bonne taille : envoyé tel quel, sans décodage
+    # JPEG : décodage directement à échelle réduite (no-op pour les autres formats)
+    image.draft("RGB", (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+    image.load()
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if max(image.size) > IMAGE_MAX_SIDE:
+        # Après draft() l'image fait au plus ~2x la cible : LANCZOS reste peu coûteux et garde le texte lisible
+        image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    # Pas de passe Huffman optimisée ni de progressif : encodage plus rapide, taille quasi identique
+    image.save(buf, "JPEG", quality=JPEG_QUALITY, optimize=False, progressive=False)
+    return buf.getvalue()
+
+def _safe_encode_image(data: bytes):
+    """Retourne (jpeg, None) ou (None, erreur) pour remonter les erreurs au thread principal"""
+    try:
+        return _encode_image(data), None
+    except Exception as e:
+        return None, str(e)
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def _encode_images(blobs: tuple) -> list:
+    """Traitement parallèle (le décodage libère le GIL), mis en cache sur le contenu des fichiers"""
+    with ThreadPoolExecutor(max_workers=min(8, len(blobs))) as ex:
+        return list(ex.map(_safe_encode_image, blobs))
+
 def process_images(uploaded_files):
-    """Conversion images pour Gemini (PIL)"""
+    """Conversion images en parts JPEG inline pour Gemini, réduites à IMAGE_MAX_SIDE px de côté max.
+    Les mêmes fichiers ré-analysés ne sont pas redécodés (cache sur leurs octets)."""
+    if not uploaded_files:
+        return []
+
     processed_images = []
-    for uploaded_file in uploaded_files:
-        try:
-            image = Image.open(uploaded_file)
-            if image.mode != "RGB":
-                image = image.convert("RGB")
-            processed_images.append(image)
-        except Exception as e:
-            st.error(f"Erreur lecture image: {e}")
+    for jpeg, error in _encode_images(tuple(f.getvalue() for f in uploaded_files)):
+        if error is not None:
+            st.error(f"Erreur lecture image: {error}")
+        else:
+            processed_images.append(types.Part.from_bytes(data=jpeg, mime_type='image/jpeg'))
     return processed_images
 
-def fetch_url_content(url):
-    """Scraping HTML via Requests (Remplace le proxy JS)"""
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-    }
-    try:
-        response = requests.get(url, headers=headers, timeout=10)
+# Plafond du HTML brut téléchargé. Volontairement large : le texte utile d'une annonce arrive souvent
+# après plusieurs centaines de Ko de <head> (scripts, JSON inline) ; c'est le texte extrait qui est limité.
+MAX_PAGE_BYTES = 1_000_000
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=128)
+def fetch_url_content(url: str) -> str:
+    """Scraping via Requests puis extraction du texte visible (sans scripts, styles, navigation).
+    Mis en cache par URL ; les erreurs remontent à l'appelant (et ne sont donc pas cachées)."""
+    # Lecture en flux plafonnée : les pages très lourdes ne sont jamais chargées entièrement en mémoire
+    buf = bytearray()
+    with _get_session().get(url, timeout=HTTP_TIMEOUT, stream=True) as response:
         response.raise_for_status()
-        return response.text[:30000] # Limite pour les tokens
-    except Exception as e:
-        st.warning(f"Scraping direct échoué ({e}). Utilisation de l'URL seule.")
-        return None
+        for chunk in response.iter_content(chunk_size=8192):
+            buf.extend(chunk)
+            if len(buf) >= MAX_PAGE_BYTES:
+                break
+        encoding = response.encoding or 'utf-8'
+    try:
+        html = buf[:MAX_PAGE_BYTES].decode(encoding, errors='replace')
+    except LookupError:  # Charset annoncé inconnu de Python (ex: utf8mb4)
+        html = buf[:MAX_PAGE_BYTES].decode('utf-8', errors='replace')
+    tree = LexborHTMLParser(html)
+    for tag in tree.css('script, style, nav, footer, header'):
+        tag.decompose()
+    text = tree.body.text(separator=' ', strip=True) if tree.body else ''
+    return text[:8000] # Limite pour les tokens
+
+GEMINI_MODEL = 'gemini-3-flash-preview'
+
+# Instruction statique d'extraction : passée en system_instruction
+EXTRACTION_INSTRUCTION = """Agis comme un expert immobilier. Extrais les données de l'annonce fournie.
+Date au format YYYY-MM-DD, quartier = quartier ou station de métro, DPE = A, B, C, D, E, F ou na.
+Si inconnu, mets 0 ou chaine vide."""
+
+# Schéma de sortie structurée Gemini (remplace la description JSON en texte libre)
+EXTRACTION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "date": {"type": "STRING"},
+        "ville": {"type": "STRING"},
+        "quartier": {"type": "STRING"},
+        "prix": {"type": "NUMBER"},
+        "surface": {"type": "NUMBER"},
+        "dpe": {"type": "STRING"},
+        "type_vendeur": {"type": "STRING", "enum": list(VENDEUR_OPTIONS)},
+        "email": {"type": "STRING"},
+        "telephone": {"type": "STRING"},
+    },
+}
+
+EXTRACTION_CONFIG = {
+    "system_instruction": EXTRACTION_INSTRUCTION,
+    "response_mime_type": "application/json",
+    "response_schema": EXTRACTION_SCHEMA,
+    "temperature": 0,
+}
+
+@st.cache_resource(show_spinner=False)
+def _get_client(api_key: str):
+    """Client Gemini par clé API, partagé entre les reruns et les sessions (pas d'état global mutable)"""
+    return genai.Client(api_key=api_key)
+
+def _fetch_in_thread(ctx, url):
+    """fetch_url_content depuis un thread de pool, rattaché au contexte du script (requis par st.cache_data)"""
+    add_script_run_ctx(threading.current_thread(), ctx)
+    return fetch_url_content(url)
+
+def analyze_with_gemini(api_key, raw_text, url_input, uploaded_files):
+    """ETL : Extraction Transform Load via Gemini 3.0 Flash (sortie JSON structurée).
+    Le scraping de l'URL tourne en parallèle du traitement des images."""
+    if not (url_input or raw_text.strip() or uploaded_files):
+        return {}
 
-def analyze_with_gemini(api_key, raw_text, url_input, images):
-    """ETL : Extraction Transform Load via Gemini 3.0 Flash"""
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-3-flash-preview')
+    page = None
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        page_future = ex.submit(_fetch_in_thread, get_script_run_ctx(), url_input) if url_input else None
+        images = process_images(uploaded_files)
+        if page_future:
+            try:
+                page = page_future.result()
+            except Exception as e:  # Toute erreur de scraping/parsing : repli sur l'URL seule (non mis en cache)
+                st.warning(f"Scraping direct échoué ({e}). Utilisation de l'URL seule.")
+
+    client = _get_client(api_key)
     
-    prompt = [
-        """Agis comme un expert immobilier. Extrais les données au format JSON strict :
-        {
-            "date": "YYYY-MM-DD", "ville": "Ville", "quartier": "Quartier/Métro",
-            "prix": Float, "surface": Float, "type_vendeur": "Agence"|"Particulier",
-            "email": "email ou vide", "telephone": "tel ou vide"
-            "DPE" : "A, B, C, D, E, F ou na"
-        }
-        Si inconnu, mets 0 ou chaine vide."""
-    ]
+    prompt = []
 
     if url_input:
-        html = fetch_url_content(url_input)
-        prompt.append(f"Source HTML : \n{html}" if html else f"Source URL : {url_input}")
+        prompt.append(f"Source Page : \n{page}" if page else f"Source URL : {url_input}")
     
-    if raw_text:
+    if raw_text.strip():
         prompt.append(f"Source Texte : \n{raw_text}")
     
     prompt.extend(images)
 
     try:
-        response = model.generate_content(prompt)
-        # Nettoyage JSON robuste
-        json_str = response.text.replace("```json", "").replace("```", "").strip()
-        start, end = json_str.find('{'), json_str.rfind('}') + 1
-        return json.loads(json_str[start:end]) if start != -1 else {}
+        # Streaming : la réponse partielle s'affiche au fil de l'eau dans un expander de debug
+        debug = st.expander("Réponse brute Gemini").empty()
+        chunks = []
+        for chunk in client.models.generate_content_stream(model=GEMINI_MODEL, contents=prompt, config=EXTRACTION_CONFIG):
+            chunks.append(chunk.text or "")
+            debug.code("".join(chunks), language="json")
+        # Mode JSON natif : pas de markdown autour, on parse directement
+        return orjson.loads("".join(chunks))
+    except orjson.JSONDecodeError as e:
+        st.error(f"Réponse Gemini non JSON: {e}")
+        return None
     except Exception as e:
         st.error(f"Erreur Gemini: {e}")
         return None
 
+# Modèle de message statique en system_instruction : seul le quartier varie d'un appel à l'autre
+DRAFT_INSTRUCTION = """Génère un message pour un vendeur immobilier. Remplace [Quartier] par le quartier fourni.
+Garde EXACTEMENT ce modèle :
+Bonjour,
+J'ai vu votre annonce pour l'appartement situé [Quartier] et je suis très intéressé.
+Je m'appelle Robin, j'ai 24 ans, ingénieur. Dossier validé (250k€), sans condition suspensive.
+Disponible rapidement pour visiter.
+Cordialement,
+Robin Sarriaud
+0610980100
+robin.sarriaud@gmail.com"""
+
+DRAFT_CONFIG = {"system_instruction": DRAFT_INSTRUCTION}
+
 def generate_draft_message(api_key, quartier):
-    """Génération Template Robin"""
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-3-flash-preview')
+    """Génération Template Robin (générateur de morceaux de texte, pour st.write_stream)"""
+    client = _get_client(api_key)
     
-    prompt = f"""
-    Génère un message pour un vendeur immobilier. Remplace [Quartier] par "{quartier}".
-    Garde EXACTEMENT ce modèle :
-    Bonjour,
-    J'ai vu votre annonce pour l'appartement situé [Quartier] et je suis très intéressé.
-    Je m'appelle Robin, j'ai 24 ans, ingénieur. Dossier validé (250k€), sans condition suspensive.
-    Disponible rapidement pour visiter.
-    Cordialement,
-    Robin Sarriaud
-    0610980100
-    robin.sarriaud@gmail.com
-    """
+    prompt = f'Quartier : "{quartier}"'
     try:
-        return model.generate_content(prompt).text
+        for chunk in client.models.generate_content_stream(model=GEMINI_MODEL, contents=prompt, config=DRAFT_CONFIG):
+            yield chunk.text or ""
     except Exception:
-        return "Erreur génération message."
+        yield "Erreur génération message."
 
 def send_to_webhook(webhook_url, data):
     """Envoi vers Google Apps Script"""
     try:
-        # Requests gère le JSON proprement (pas besoin de no-cors comme en JS)
-        resp = requests.post(webhook_url, json=data, headers={'Content-Type': 'application/json'})
-        return resp.status_code in [200, 302]
+        # Sérialisation unique via orjson ; Apps Script répond 302 une fois le doPost exécuté,
+        # inutile de suivre la redirection (GET supplémentaire)
+        resp = _get_session().post(
+            webhook_url,
+            data=orjson.dumps(data),
+            headers={'Content-Type': 'application/json'},
+            timeout=HTTP_TIMEOUT,
+            allow_redirects=False,
+        )
+        if resp.status_code not in [200, 302]:
+            st.error(f"Webhook a répondu {resp.status_code}: {resp.text[:200]}")
+            return False
+        return True
     except Exception as e:
         st.error(f"Erreur Webhook: {e}")
         return False
 
 # --- 3. STATE MANAGEMENT ---
 
+# Champs affichés dans le formulaire : chaque widget a la clé f_<champ> dans st.session_state
+FORM_FIELDS = (
+    'date', 'ville', 'prix', 'email', 'quartier', 'surface', 'dpe', 'type_vendeur',
+    'telephone', 'message_draft', 'create_draft', 'status', 'commentaire',
+)
+
+def _widget_value(field, value):
+    """Normalise une valeur pour le widget correspondant (types et options valides)"""
+    if field in ('prix', 'surface'):
+        return float(value or 0)
+    if field == 'type_vendeur':
+        return VENDEUR_OPTIONS[VENDEUR_INDEX.get(value, 0)]
+    if field == 'status':
+        return STATUS_OPTIONS[STATUS_INDEX.get(value, 1)]
+    if field == 'create_draft':
+        return bool(value)
+    # On utilise "or" pour coalescer None vers ""
+    return value or ""
+
+def load_form(data):
+    """Met à jour form_data et les clés des widgets des champs fournis : le formulaire, rendu plus bas
+    dans le script, affiche les nouvelles valeurs sans st.rerun()"""
+    st.session_state.form_data.update(data)
+    for field in FORM_FIELDS:
+        if field in data:
+            st.session_state[f"f_{field}"] = _widget_value(field, data[field])
+
 if 'form_data' not in st.session_state:
-    st.session_state.form_data = ImmoData().model_dump()
+    st.session_state.form_data = {}
+    load_form({**_empty_form_template(), 'date': datetime.now().strftime("%Y-%m-%d")})
 
 # --- 4. INTERFACE ---
 
@@ -198,15 +370,14 @@ with col_in:
     if st.button("🪄 Analyser", type="primary", use_container_width=True):
         if not api_key:
             st.error("API Key manquante.")
+        elif not (url_in or text_in.strip() or files):
+            st.warning("Fournis au moins une source.")
         else:
             with st.spinner("Analyse en cours..."):
-                imgs = process_images(files) if files else []
-                data = analyze_with_gemini(api_key, text_in, url_in, imgs)
+                data = analyze_with_gemini(api_key, text_in, url_in, files)
                 if data:
                     # Update partiel pour ne pas écraser les champs système
-                    st.session_state.form_data.update(data)
-                    st.session_state.form_data['url'] = url_in
-                    st.rerun()
+                    load_form({**data, 'url': url_in})
 
 with col_out:
     if st.session_state.form_data:
@@ -215,29 +386,30 @@ with col_out:
         with st.form("main_form"):
             c1, c2 = st.columns(2)
             # Mapping des champs
-            st.session_state.form_data['date'] = c1.text_input("Date", st.session_state.form_data['date'])
-            st.session_state.form_data['ville'] = c1.text_input("Ville", st.session_state.form_data['ville'])
-            st.session_state.form_data['prix'] = c1.number_input("Prix (€)", value=float(st.session_state.form_data['prix']))
-            st.session_state.form_data['email'] = c1.text_input("Email", st.session_state.form_data['email'])
-
-            st.session_state.form_data['quartier'] = c2.text_input("Quartier", st.session_state.form_data['quartier'])
-            st.session_state.form_data['surface'] = c2.number_input("Surface (m²)", value=float(st.session_state.form_data['surface']))
-            # On utilise "or" pour coalescer None vers ""
-            st.session_state.form_data['dpe'] = c2.text_input("DPE", value=st.session_state.form_data['dpe'] or "")
-            st.session_state.form_data['type_vendeur'] = c2.selectbox("Vendeur", ["Agence", "Particulier", "Autre"], index=["Agence", "Particulier", "Autre"].index(st.session_state.form_data.get('type_vendeur', 'Agence')))
-            st.session_state.form_data['telephone'] = c2.text_input("Téléphone", st.session_state.form_data['telephone'])
+            st.session_state.form_data['date'] = c1.text_input("Date", key="f_date")
+            st.session_state.form_data['ville'] = c1.text_input("Ville", key="f_ville")
+            st.session_state.form_data['prix'] = c1.number_input("Prix (€)", key="f_prix")
+            st.session_state.form_data['email'] = c1.text_input("Email", key="f_email")
+
+            st.session_state.form_data['quartier'] = c2.text_input("Quartier", key="f_quartier")
+            st.session_state.form_data['surface'] = c2.number_input("Surface (m²)", key="f_surface")
+            st.session_state.form_data['dpe'] = c2.text_input("DPE", key="f_dpe")
+            st.session_state.form_data['type_vendeur'] = c2.selectbox("Vendeur", VENDEUR_OPTIONS, key="f_type_vendeur")
+            st.session_state.form_data['telephone'] = c2.text_input("Téléphone", key="f_telephone")
 
             st.divider()
             
             # Gestion Message
             c_gen, c_txt = st.columns([1, 3])
             if c_gen.form_submit_button("🤖 Générer Msg"):
-                msg = generate_draft_message(api_key, st.session_state.form_data['quartier'])
-                st.session_state.form_data['message_draft'] = msg
-                st.rerun()
+                # Streaming dans un emplacement temporaire, puis le texte va dans le widget Message
+                stream_box = c_txt.empty()
+                msg = stream_box.write_stream(generate_draft_message(api_key, st.session_state.form_data['quartier']))
+                stream_box.empty()
+                load_form({'message_draft': msg})
             
             # Affichage et Edition
-            st.session_state.form_data['message_draft'] = c_txt.text_area("Message", st.session_state.form_data['message_draft'], height=150)
+            st.session_state.form_data['message_draft'] = c_txt.text_area("Message", key="f_message_draft", height=150)
             
             # --- MODIFICATION : Bloc "Code" pour copier-coller natif ---
             if st.session_state.form_data.get('message_draft'):
@@ -247,9 +419,9 @@ with col_out:
             
             # Options finales
             cc1, cc2 = st.columns(2)
-            st.session_state.form_data['create_draft'] = cc1.toggle("Envoi Email Automatique", st.session_state.form_data['create_draft'])
-            st.session_state.form_data['status'] = cc2.selectbox("Status", ["Non", "A contacter", "Contacté"], index=["Non", "A contacter", "Contacté"].index(st.session_state.form_data.get('status', 'A contacter')))
-            st.session_state.form_data['commentaire'] = st.text_area("Note", st.session_state.form_data['commentaire'], height=68)
+            st.session_state.form_data['create_draft'] = cc1.toggle("Envoi Email Automatique", key="f_create_draft")
+            st.session_state.form_data['status'] = cc2.selectbox("Status", STATUS_OPTIONS, key="f_status")
+            st.session_state.form_data['commentaire'] = st.text_area("Note", key="f_commentaire", height=68)
 
             # Submit final
             if st.form_submit_button("🚀 Envoyer vers Sheets", type="primary", use_container_width=True):